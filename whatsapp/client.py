@@ -24,14 +24,75 @@ import os
 import typing
 import traceback
 import selenium.webdriver
+import selenium.webdriver.common.by
+import selenium.webdriver.common.keys
+import selenium.webdriver.support.expected_conditions
+import selenium.webdriver.support.ui
 import selenium.common
 import webdriver_manager.chrome
 import whatsapp.exceptions
 import whatsapp.message
 import whatsapp.person
 
+# The minimum and maximum time in seconds the client waits between checking for new messages.
+MIN_IDLE_TIME = 0.1
+MAX_IDLE_TIME = 1.0
+
+# The maximum size of a file that can be sent, in bytes.
+MAX_FILE_BYTES = 64_000_000
+
+# The locators of the elements the client caches.
+SEND_INPUT_LOCATOR = (selenium.webdriver.common.by.By.CSS_SELECTOR, "#main footer div[contenteditable='true']")
+PANE_SIDE_LOCATOR = (selenium.webdriver.common.by.By.ID, "pane-side")
+CONVERSATION_PANEL_LOCATOR = (selenium.webdriver.common.by.By.ID, "main")
+
+# The selectors of the file inputs in the attach menu, per file type.
+FILE_INPUT_SELECTORS = {
+    "other": "input[accept='*']",
+    "img": "input[accept^='image/']"
+}
+
+# Collects everything the client needs to know about the newest message in the given conversation panel,
+# so it only takes one round trip to the browser. Returns null when there are no messages.
+# The text is read with JS to get the emoticons from the message too. When the message has no text but is an
+# image, the text is "". When it has neither, the text is null.
+LAST_MESSAGE_SCRIPT = """
+const messages = arguments[0].querySelectorAll(".focusable-list-item");
+if (!messages.length) {
+    return null;
+}
+const message = messages[messages.length - 1];
+
+let text = null;
+const textElement = message.querySelector(".selectable-text");
+if (textElement) {
+    text = "";
+    textElement.firstChild.childNodes.forEach(child => {
+        if (child.nodeType === Node.TEXT_NODE) {
+            text += child.textContent;
+        } else if (child.tagName === "IMG") {
+            text += child.alt;
+        }
+    });
+} else if (document.evaluate("./div/div[1]/div/div/div[1]/div/div[2]/img", message, null,
+                             XPathResult.FIRST_ORDERED_NODE_TYPE, null).singleNodeValue) {
+    text = "";
+}
+
+const idElement = message.hasAttribute("data-id") ? message : message.querySelector("[data-id]");
+
+return {
+    element: message,
+    text: text,
+    is_out: message.className.includes("message-out"),
+    id: idElement ? idElement.getAttribute("data-id") : null
+};
+"""
+
 
-class WhatsappClient:
+# Besides the original attributes, the client caches three elements and the help command's list of command names,
+# so they don't have to be retrieved or rebuilt every time they are used.
+class WhatsappClient:  # pylint: disable=too-many-instance-attributes
     """This creates a Whatsapp client.
 
     This class can be used to:
@@ -46,7 +107,7 @@ class WhatsappClient:
     This command can be removed by using the remove_command() method.
 
     Attributes:
-        command_prefix (str): the prefix the user needs to add to the command.
+        command_prefix (str): the prefix the user needs to add to the command. Must be a single character.
         debug_exception (bool): if True, when an error occurs the client will send the exception
                                 instead of the default error message.
         debug_traceback (bool): if True, when an error occurs the client will send the traceback
@@ -65,15 +126,40 @@ class WhatsappClient:
 
     def __init__(self) -> None:
         self.__running = False
-        self.__commands = {"help": [self.__help_menu, "Returns help messages"]}
-        self.__on_messages = []
-        self.__on_loops = []
-        self.command_prefix = "!"
+        self.__commands = {"help": (self.__help_menu, "Returns help messages")}
+        # The comma separated command names shown by the help command. Updated when a command is added or removed.
+        self.__command_names = ", ".join(self.__commands)
+        self.__on_messages = ()
+        self.__on_loops = ()
+        self.__command_prefix = "!"
         self.debug_exception = False
         self.debug_traceback = False
         self.disable_error_handling = False
         self.__browser = None
+        # The cached elements. An element is retrieved again when it is None.
         self.__send_input = None
+        self.__pane_side = None
+        self.__conversation_panel = None
+
+    @property
+    def command_prefix(self) -> str:
+        """The prefix the user needs to add to the command.
+        """
+        return self.__command_prefix
+
+    @command_prefix.setter
+    def command_prefix(self, prefix: str) -> None:
+        """Sets the command prefix.
+
+        Args:
+            prefix (str): the new prefix.
+
+        Raises:
+            whatsapp.exceptions.InvalidPrefixError: when the prefix isn't a single character.
+        """
+        if not isinstance(prefix, str) or len(prefix) != 1:
+            raise whatsapp.exceptions.InvalidPrefixError()
+        self.__command_prefix = prefix
 
     def __handle_error(self, exception: Exception) -> None:
         """Handle an error.
@@ -97,6 +183,38 @@ class WhatsappClient:
         else:
             self.send_message("An unknown error occurred")
 
+    def __with_cached(self, element, locator: tuple, action: typing.Callable) -> tuple:
+        """Runs an action on a cached element.
+
+        The element is retrieved when it isn't cached yet. When it turns out to be stale,
+        it is retrieved again and the action is run once more.
+
+        Args:
+            element: the cached element, or None.
+            locator (tuple): the locator to retrieve the element with.
+            action (callable): the function to run. It receives the element.
+
+        Returns:
+            a tuple with the element to cache and the result of the action.
+
+        Raises:
+            selenium.common.exceptions.NoSuchElementException: when the element can't be found.
+        """
+        if element is None:
+            element = self.__browser.find_element(*locator)
+        try:
+            return element, action(element)
+        except selenium.common.exceptions.StaleElementReferenceException:
+            element = self.__browser.find_element(*locator)
+            return element, action(element)
+
+    def __clear_element_cache(self) -> None:
+        """Clears the cached elements. This needs to be done when the page changes.
+        """
+        self.__send_input = None
+        self.__pane_side = None
+        self.__conversation_panel = None
+
     def set_chat(self, chat_name: str) -> None:
         """Sets the chat the bot is on.
 
@@ -107,10 +225,14 @@ class WhatsappClient:
             whatsapp.exceptions.UnknownChatError: raises when the chat is not found.
         """
         # Retrieve all the chats from the sidebar.
-        chats = self.__browser.find_element_by_id("pane-side").find_elements_by_tag_name("span")
+        self.__pane_side, chats = self.__with_cached(
+            self.__pane_side, PANE_SIDE_LOCATOR,
+            lambda pane_side: pane_side.find_elements(selenium.webdriver.common.by.By.TAG_NAME, "span"))
         for chat in chats:
             if chat.text == chat_name:
                 chat.click()
+                # The conversation panel has been replaced, so the cached elements aren't valid anymore.
+                self.__clear_element_cache()
                 return
         raise whatsapp.exceptions.UnknownChatError(chat_name)
 
@@ -129,12 +251,9 @@ class WhatsappClient:
         """
 
         def add_command(command_function: typing.Callable[[list, whatsapp.message.Message], typing.Any]):
-            self.__commands[name] = [command_function, help_message]
-
-            def run_command(args: list, msg_obj: whatsapp.message.Message):
-                command_function(args, msg_obj)
-
-            return run_command
+            self.__commands[name] = (command_function, help_message)
+            self.__command_names = ", ".join(self.__commands)
+            return command_function
 
         return add_command
 
@@ -151,6 +270,7 @@ class WhatsappClient:
             self.__commands.pop(name)
         except KeyError as command_not_found:
             raise whatsapp.exceptions.CommandNotFoundError() from command_not_found
+        self.__command_names = ", ".join(self.__commands)
 
     def on_message(self, on_message_function: typing.Callable[[whatsapp.message.Message],
                                                               typing.Any]) -> typing.Callable:
@@ -160,24 +280,16 @@ class WhatsappClient:
         The function will receive one argument, a whatsapp.message.Message object
         containing info about the message.
         """
-        self.__on_messages.append(on_message_function)
-
-        def run_on_message(msg):
-            on_message_function(msg)
-
-        return run_on_message
+        self.__on_messages = self.__on_messages + (on_message_function,)
+        return on_message_function
 
     def on_loop(self, on_loop_function: typing.Callable[[], typing.Any]) -> typing.Callable:
         """on_loop decorator.
 
         The function will be run when the client checks for new messages.
         """
-        self.__on_loops.append(on_loop_function)
-
-        def run_on_message():
-            on_loop_function()
-
-        return run_on_message
+        self.__on_loops = self.__on_loops + (on_loop_function,)
+        return on_loop_function
 
     def __process_commands(self, function, arguments: list, message_object: whatsapp.message.Message) -> None:
         """Processes a command.
@@ -201,8 +313,8 @@ class WhatsappClient:
         Args:
             msg_object (whatsapp.message.Message): the message object.
         """
-        on_message_listeners = self.__on_messages
-        for listener in on_message_listeners:
+        # Every listener gets its own error handling, so one failing listener doesn't stop the others.
+        for listener in self.__on_messages:
             try:
                 listener(msg_object)
             except Exception as error:
@@ -211,8 +323,7 @@ class WhatsappClient:
     def __process_loop_listeners(self) -> None:
         """Processes the loop listeners.
         """
-        on_loop_listeners = self.__on_loops
-        for listener in on_loop_listeners:
+        for listener in self.__on_loops:
             try:
                 listener()
             except Exception as error:
@@ -223,13 +334,28 @@ class WhatsappClient:
 
         Args:
             msg (str): the message to send.
+
+        Raises:
+            whatsapp.exceptions.ClientNotStartedError: when the client isn't started or no chat is open.
         """
-        for to_send in msg.splitlines():
-            try:
-                self.__send_input.clear()
-                self.__send_input.send_keys(to_send + "\n")
-            except selenium.common.exceptions.StaleElementReferenceException:
-                pass
+        lines = msg.splitlines()
+        if not lines:
+            return
+
+        keys = selenium.webdriver.common.keys.Keys
+        # Shift + Enter adds a new line without sending the message, so the whole message can be typed at once.
+        to_send = (keys.SHIFT + keys.ENTER + keys.SHIFT).join(lines) + keys.ENTER
+
+        def type_message(send_input) -> None:
+            send_input.clear()
+            send_input.send_keys(to_send)
+
+        if self.__browser is None:
+            raise whatsapp.exceptions.ClientNotStartedError()
+        try:
+            self.__send_input, _ = self.__with_cached(self.__send_input, SEND_INPUT_LOCATOR, type_message)
+        except selenium.common.exceptions.NoSuchElementException as send_input_not_found:
+            raise whatsapp.exceptions.ClientNotStartedError() from send_input_not_found
 
     def send_file(self, file_path: str, file_type="other") -> None:
         """Sends a file to the chat the client is on.
@@ -242,41 +368,34 @@ class WhatsappClient:
             whatsapp.exceptions.FileTooBigError: raises when the given file is over the limit of 64 MB.
             whatsapp.exceptions.UnknownFileTypeError: raises when an unknown file type is given.
         """
-        file_size = os.path.getsize(file_path)
-        if file_size > 64000000:
+        file_size = os.stat(file_path).st_size
+        if file_size > MAX_FILE_BYTES:
             raise whatsapp.exceptions.FileTooBigError(file_size)
+        try:
+            file_input_selector = FILE_INPUT_SELECTORS[file_type]
+        except KeyError as unknown_file_type:
+            raise whatsapp.exceptions.UnknownFileTypeError() from unknown_file_type
+
         # Retrieve the button to attach files and click it.
-        attach_file_button = self.__browser.find_element_by_xpath(
-            "/html/body/div[1]/div/div/div[4]/div/footer/div[1]/div[1]/div[2]/div")
+        self.__conversation_panel, footer = self.__with_cached(
+            self.__conversation_panel, CONVERSATION_PANEL_LOCATOR,
+            lambda panel: panel.find_element(selenium.webdriver.common.by.By.TAG_NAME, "footer"))
+        attach_file_button = footer.find_element(selenium.webdriver.common.by.By.CSS_SELECTOR,
+                                                 "[data-testid='conversation-clip']")
         attach_file_button.click()
-        if file_type == "other":
-            # Retrieve the upload input for the 'other' file button if the given file type is 'other'.
-            file_input = self.__browser.find_element_by_xpath("/html/body/div[1]/div/div/div[4]/div/footer/div["
-                                                              "1]/div[1]/div[2]/div/span/div/div/ul/li["
-                                                              "3]/button/input")
-        elif file_type == "img":
-            # Retrieve the 'image' file input if the given file type is 'img'.
-            file_input = self.__browser.find_element_by_xpath("/html/body/div[1]/div/div/div[4]/div/footer/div["
-                                                              "1]/div[1]/div[2]/div/span/div/div/ul/li["
-                                                              "1]/button/input")
-        else:
-            raise whatsapp.exceptions.UnknownFileTypeError()
+        # Retrieve the file input for the given file type.
+        file_input = footer.find_element(selenium.webdriver.common.by.By.CSS_SELECTOR, file_input_selector)
 
         # Enter the file path to the retrieved input.
         file_input.send_keys(file_path)
-        file_is_sended = False
-        time.sleep(0.5)
 
-        # Wait for the send button to appear and click the send button.
-        while file_is_sended is False:
-            try:
-                send_button = self.__browser.find_element_by_xpath(
-                    "/html/body/div[1]/div/div/div[2]/div[2]/span/div/span/div/div/div[2]/span/div")
-                send_button.click()
-                file_is_sended = True
-            except selenium.common.exceptions.NoSuchElementException:
-                time.sleep(0.5)
-                continue
+        # Wait for the send button of the media preview to appear and click it. The preview is shown outside of the
+        # conversation panel, so the send button in the footer of the conversation panel is excluded.
+        send_button = selenium.webdriver.support.ui.WebDriverWait(self.__browser, 10, poll_frequency=0.1).until(
+            selenium.webdriver.support.expected_conditions.element_to_be_clickable(
+                (selenium.webdriver.common.by.By.XPATH,
+                 "//span[@data-icon='send'][not(ancestor::*[@id='main'])]")))
+        send_button.click()
 
     def get_last_message(self) -> whatsapp.message.Message:
         """Gets the last message.
@@ -287,73 +406,33 @@ class WhatsappClient:
         Raises:
             whatsapp.exceptions.CannotFindMessageError: raises when the client can't find any message.
         """
-        # Retrieve all the messages.
-        messages = self.__browser.find_elements_by_class_name(
-            "focusable-list-item")
-        # Select the newest message.
+        # Retrieve the newest message.
         try:
-            new_message = messages[-1]
-        except IndexError as message_not_found:
+            self.__conversation_panel, new_message = self.__with_cached(
+                self.__conversation_panel, CONVERSATION_PANEL_LOCATOR,
+                lambda panel: self.__browser.execute_script(LAST_MESSAGE_SCRIPT, panel))
+        except selenium.common.exceptions.NoSuchElementException as message_not_found:
             raise whatsapp.exceptions.CannotFindMessageError() from message_not_found
-        try:
-            # Retrieve the text in the message.
-            new_message_text_element = new_message.find_element_by_css_selector(
-                ".selectable-text")
-            # This is done with JS to get the emoticons from the message too.
-            new_message_text = self.__browser.execute_script("""
-                                        var new_message = arguments[0];
-                                        var text = new_message.firstChild;
-                                        var child = text.firstChild;
-                                        var ret = "";
-                                        while(child) {
-                                        if (child.nodeType === Node.TEXT_NODE){
-                                            ret += child.textContent;
-                                        }
-                                        else if(child.tagName.toLowerCase() === "img"){
-                                            ret += child.alt;
-                                        }
-                                        child = child.nextSibling;
-                                        }
-                                        return ret;
-                                    """, new_message_text_element)
-        except selenium.common.exceptions.NoSuchElementException:
-            try:
-                # The message could possibly be an image. If so, retrieve the image and set the message text to "".
-                new_message.find_element_by_xpath("./div/div[1]/div/div/div[1]/div/div[2]/img")
-                new_message_text = ""
-            except selenium.common.exceptions.NoSuchElementException as message_not_found:
-                raise whatsapp.exceptions.CannotFindMessageError() from message_not_found
+        if new_message is None or new_message["text"] is None:
+            raise whatsapp.exceptions.CannotFindMessageError()
 
         sender: whatsapp.person.PersonDict = {
-            "this_person": "message-out" in new_message.get_attribute("class")
+            "this_person": new_message["is_out"]
         }
 
-        return whatsapp.message.Message(sender, new_message_text, new_message, self.__browser)
+        return whatsapp.message.Message(sender, new_message["text"], new_message["element"], self.__browser,
+                                        new_message["id"])
 
     def __help_menu(self, arguments: list, message_obj: whatsapp.message.Message) -> None:
         if len(arguments) == 0:
-
-            answer = "List of commands:\n"
-            for command in self.__commands:
-                answer = answer + f"{command.replace(self.command_prefix, '')}, "
-
-            self.send_message(answer)
+            self.send_message("List of commands:\n" + self.__command_names)
             return
-        else:
-            for command in self.__commands:
-                if arguments[0] == command.replace(self.command_prefix, ""):
-                    answer = self.__commands[command][1]
 
-                    self.send_message(answer)
-                    return
-
-        self.send_message("Command not found!")
+        command = self.__commands.get(arguments[0])
+        self.send_message(command[1] if command else "Command not found!")
 
     def run(self) -> None:
         """Starts the client.
-
-        Raises:
-            whatsapp.exceptions.InvalidPrefixError: when an invalid prefix has been set.
         """
 
         self.__running = True
@@ -361,16 +440,23 @@ class WhatsappClient:
 
         self.__browser.get("https://web.whatsapp.com/")
 
-        last_message = ""
+        # The id of the last message, or its contents when WhatsApp didn't give the message an id.
+        last_message_key = ""
+        # The time to wait before checking for new messages again. This gets doubled every time there's no new
+        # message and is reset when a new message arrives.
+        idle_time = MIN_IDLE_TIME
 
         while self.__running:
 
-            try:
-                self.__send_input = self.__browser.find_element_by_xpath(
-                    "/html/body/div[1]/div/div/div[4]/div/footer/div[1]/div[2]/div/div[2]")
-            except selenium.common.exceptions.NoSuchElementException:
-                time.sleep(5)
-                continue
+            if self.__send_input is None:
+                try:
+                    # Wait for the send input to appear. It won't be there until the QR code has been scanned.
+                    self.__send_input = selenium.webdriver.support.ui.WebDriverWait(
+                        self.__browser, 5, poll_frequency=0.1).until(
+                        selenium.webdriver.support.expected_conditions.presence_of_element_located(
+                            SEND_INPUT_LOCATOR))
+                except selenium.common.exceptions.TimeoutException:
+                    continue
 
             self.__process_loop_listeners()
 
@@ -378,59 +464,59 @@ class WhatsappClient:
                 new_message_object = self.get_last_message()
                 self.__process_message_listeners(new_message_object)
             except whatsapp.exceptions.CannotFindMessageError:
+                time.sleep(idle_time)
+                idle_time = min(idle_time * 2, MAX_IDLE_TIME)
                 continue
 
-            if new_message_object is None:
-                time.sleep(0.5)
-                continue
             new_message = new_message_object.contents
 
-            if new_message != last_message:
-                last_message = new_message
+            new_message_key = new_message_object.message_id
+            if new_message_key is None:
+                new_message_key = new_message
 
-                try:
-                    if new_message[0] != self.command_prefix:
-                        continue
-                except IndexError as message_error:
-                    if new_message == "":
-                        continue
-                    raise whatsapp.exceptions.InvalidPrefixError() from message_error
+            if new_message_key == last_message_key:
+                time.sleep(idle_time)
+                idle_time = min(idle_time * 2, MAX_IDLE_TIME)
+                continue
 
-                command_message = new_message[1:]
+            idle_time = MIN_IDLE_TIME
+            last_message_key = new_message_key
 
-                try:
-                    if not command_message.split()[0] in self.__commands:
-                        self.send_message("Command not found!")
-                        continue
-                except IndexError:
-                    self.send_message("Command not found!")
-                    continue
+            if not new_message.startswith(self.__command_prefix):
+                continue
+
+            command_message = new_message[1:]
 
-                for command in self.__commands:
-                    if command == command_message.split()[0]:
-                        function_name = self.__commands[command][0]
-                        arguments = command_message.split()[1:]
-                        self.__process_commands(function_name, arguments, new_message_object)
-                        break
+            # Any whitespace separates the command name from the arguments, including new lines.
+            parts = command_message.split(maxsplit=1)
+            command = self.__commands.get(parts[0]) if parts else None
+            if command is None:
+                self.send_message("Command not found!")
+                continue
+
+            arguments = parts[1].split() if len(parts) > 1 else []
+            self.__process_commands(command[0], arguments, new_message_object)
 
     def stop(self):
         """Stops the Whatsapp Client
         """
         self.__running = False
+        self.__clear_element_cache()
 
         # Retrieve the settings button and click it.
-        self.__browser.find_element_by_xpath(
-            "/html/body/div[1]/div/div/div[3]/div/header/div[2]/div/span/div[3]/div").click()
-        time.sleep(1)
-
-        # Retrieve the logout button and click it.
-        self.__browser.find_element_by_xpath(
-            "/html/body/div[1]/div/div/div[3]/div/header/div[2]/div/span/div[3]/span/div/ul/li[7]").click()
-        time.sleep(1)
+        self.__browser.find_element(selenium.webdriver.common.by.By.CSS_SELECTOR,
+                                    "#side header [data-testid='menu']").click()
+
+        # Wait for the logout button to appear and click it.
+        selenium.webdriver.support.ui.WebDriverWait(self.__browser, 10, poll_frequency=0.1).until(
+            selenium.webdriver.support.expected_conditions.element_to_be_clickable(
+                (selenium.webdriver.common.by.By.CSS_SELECTOR, "[data-testid='mi-logout']"))).click()
+
         # If there is a warning pop up, click yes.
         try:
-            self.__browser.find_element_by_xpath(
-                "/html/body/div[1]/div/span[2]/div/div/div/div/div/div/div[3]/div[2]").click()
-        except selenium.common.exceptions.NoSuchElementException:
+            selenium.webdriver.support.ui.WebDriverWait(self.__browser, 1, poll_frequency=0.1).until(
+                selenium.webdriver.support.expected_conditions.element_to_be_clickable(
+                    (selenium.webdriver.common.by.By.CSS_SELECTOR, "[data-testid='popup-controls-ok']"))).click()
+        except selenium.common.exceptions.TimeoutException:
             pass
         self.__browser.quit()
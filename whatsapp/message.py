@@ -2,6 +2,7 @@
 """
 
 import selenium.common.exceptions
+import selenium.webdriver.common.by
 import PIL
 import whatsapp.exceptions
 import whatsapp.person
@@ -17,14 +18,17 @@ class Message:
     Attributes:
         sender (whatsapp.person.PersonDict): the sender of the message
         contents (str): the contents of the message
+        message_id (str): the id WhatsApp gave the message, or None when it doesn't have one
 
     Methods:
         get_image: downloads the image attached to the message.
     """
 
-    def __init__(self, sender: whatsapp.person.PersonDict, contents: str, selenium_object, browser) -> None:
+    def __init__(self, sender: whatsapp.person.PersonDict, contents: str, selenium_object, browser,
+                 message_id=None) -> None:
         self.sender = sender
         self.contents = contents
+        self.message_id = message_id
         self.__selenium_object = selenium_object
         self.__browser = browser
 
@@ -40,13 +44,14 @@ class Message:
         # Try to download the image. If the image can"t be find, return an error.
         try:
             # Retrieve the image element from the message and get the image source.
-            img_element = self.__selenium_object.find_element_by_xpath("./div/div[1]/div/div/div[1]/div/div[2]/img")
+            img_element = self.__selenium_object.find_element(selenium.webdriver.common.by.By.XPATH,
+                                                              "./div/div[1]/div/div/div[1]/div/div[2]/img")
             img_link = img_element.get_attribute("src")
             # Open the image in a new tabblad and switch to it.
             self.__browser.execute_script("window.open(arguments[0], '_blank');", img_link)
             self.__browser.switch_to.window(self.__browser.window_handles[1])
             # Make a screenshot of the image, crop it and save it.
-            img_element_screenshot = self.__browser.find_element_by_tag_name("img")
+            img_element_screenshot = self.__browser.find_element(selenium.webdriver.common.by.By.TAG_NAME, "img")
             img_location = img_element_screenshot.location
             img_size = img_element_screenshot.size
             self.__browser.save_screenshot("./picture.png")